@@ -18,6 +18,9 @@
             pandoc
             python39
             python39Packages.beautifulsoup4
+            python39Packages.lxml
+            python39Packages.msgpack
+            python39Packages.pillow
             texlive.combined.scheme-full
           ];
         };
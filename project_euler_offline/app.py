@@ -1,180 +1,292 @@
 import argparse
 import asyncio
+import functools
+import itertools
 import logging
+import os
+import re
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-import pydash
-from bs4 import BeautifulSoup
+from PIL import Image
 from tqdm import tqdm
 
-from project_euler_offline.document_builder import DocumentBuilder
+from project_euler_offline.document_builder import DocumentBuilder, render_problem
 from project_euler_offline.http_document_cache import (
     HttpDocumentCache,
     MissingDataError,
 )
+from project_euler_offline.pandoc_server import (
+    disable_shared_pandoc_server,
+    get_shared_pandoc_server,
+)
 
 logger = logging.getLogger(__name__)
 
+_RE_SNAKE_CASE_WORDS = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
+
+def _snake_case(text):
+    return "_".join(_RE_SNAKE_CASE_WORDS.findall(text)).lower()
+
 
 class ProjectEulerOfflineApp:
     COMMANDS = ["fetch", "render"]
+    FETCH_CONCURRENCY = 32
+    RENDER_LOOKUP_BATCH_SIZE = 100
+
+    async def _fetch_all(self, problem_ids, cache_only=False, force=False):
+        semaphore = asyncio.Semaphore(self.FETCH_CONCURRENCY)
+
+        problem_urls = {
+            problem_id: self._args.base_url + f"problem={problem_id}"
+            for problem_id in problem_ids
+        }
+
+        if not force:
+            # Cached problems are found with batched lookups so only the rest are fetched:
+            cached_responses = await self._http_cache.retrieve_many(
+                list(problem_urls.values()), cache_only=True
+            )
+            problem_ids = [
+                problem_id
+                for problem_id in problem_ids
+                if problem_urls[problem_id] not in cached_responses
+            ]
+
+        with tqdm(
+            desc="Fetching problem data...", total=len(problem_ids)
+        ) as progress_bar:
+
+            async def fetch_problem(problem_id):
+                async with semaphore:
+                    try:
+                        return await self._http_cache.retrieve_data(
+                            problem_urls[problem_id], cache_only=cache_only, force=force
+                        )
+                    finally:
+                        progress_bar.update(1)
+
+            results = await asyncio.gather(
+                *(fetch_problem(problem_id) for problem_id in problem_ids),
+                return_exceptions=True,
+            )
+
+        for problem_id, result in zip(problem_ids, results):
+            if isinstance(result, MissingDataError):
+                logger.error(f"failed to retrieve problem #{problem_id}")
+            elif isinstance(result, Exception):
+                raise result
+
+    def _convert_gif_resource(self, resource_url_path, resource_file_path):
+        with Image.open(resource_file_path) as image:
+            gif_frame_count = getattr(image, "n_frames", 1)
+
+        subprocess.run(
+            [
+                "convert",
+                "-coalesce",
+                "-despeckle",
+                str(resource_file_path),
+                str(resource_file_path.with_suffix(".png")),
+            ]
+        )
+
+        return dict(
+            url_path=resource_url_path,
+            file_path=resource_file_path.relative_to(self._output_path),
+            frame_count=gif_frame_count,
+        )
 
     def _retrieve_http_data(self, url_path, **kwargs):
-        return asyncio.run(
+        return self._run(
             self._http_cache.retrieve_data(self._args.base_url + url_path, **kwargs)
         )
 
-    def _write_http_resource(self, url_path, store_in_base=False, **kwargs):
-        data = self._retrieve_http_data(url_path, **kwargs)
+    def _retrieve_many_http_data(self, url_paths, cache_only=False, force=False):
+        if force:
+            return {
+                url_path: self._retrieve_http_data(
+                    url_path, cache_only=cache_only, force=force
+                )
+                for url_path in url_paths
+            }
+
+        responses = self._run(
+            self._http_cache.retrieve_many(
+                [self._args.base_url + url_path for url_path in url_paths],
+                cache_only=cache_only,
+            )
+        )
+        url_path_responses = {}
+
+        for url_path in url_paths:
+            response = responses.get(self._args.base_url + url_path)
+
+            if isinstance(response, Exception):
+                raise response
+
+            url_path_responses[url_path] = response
+
+        return url_path_responses
+
+    def _run(self, coroutine):
+        # A single event loop is kept so the HTTP session can be reused across calls:
+        try:
+            return self._event_loop.run_until_complete(coroutine)
+        finally:
+            # The flush timer cannot fire while the loop is idle, so commit pending writes now:
+            self._http_cache.flush_pending_writes()
+
+    def _write_http_resource(self, url_path, data, store_in_base=False):
         path = self._output_path / (
             Path(url_path).name if store_in_base else Path(url_path)
         )
         path.parent.mkdir(parents=True, exist_ok=True)
         path.write_bytes(data)
-        return data, path
+        return path
 
     def command_fetch(self):
         problem_ids = list(self.iterate_problem_ids())
 
         if problem_ids:
-            for problem_id in problem_ids:
-                try:
-                    self.retrieve_problem_html(
-                        problem_id,
-                        cache_only=self._args.cache_only,
-                        force=self._args.force,
-                    )
-                except MissingDataError:
-                    logger.error(f"failed to retrieve problem #{problem_id}")
+            self._run(
+                self._fetch_all(
+                    problem_ids,
+                    cache_only=self._args.cache_only,
+                    force=self._args.force,
+                )
+            )
         else:
             recent_problems_html = self._retrieve_http_data(
                 "recent", cache_disable=True
             ).decode("utf8")
-            recent_problems_parsed = BeautifulSoup(recent_problems_html, "html.parser")
-            recent_problem_id_tags = recent_problems_parsed.find(
-                id="problems_table"
-            ).find_all(class_="id_column")
-
-            if recent_problem_id_tags:
-                latest_problem_id = max(
-                    int(recent_problem_id_tag.text)
-                    for recent_problem_id_tag in recent_problem_id_tags[1:]
+            recent_problem_ids = [
+                int(recent_problem_id)
+                for recent_problem_id in re.findall(
+                    r'class="id_column"[^>]*>\s*(\d+)\s*<', recent_problems_html
                 )
+            ]
 
-                for problem_id in tqdm(
-                    range(1, latest_problem_id + 1), desc="Fetching problem data..."
-                ):
-                    try:
-                        self._retrieve_http_data(f"problem={problem_id}")
-                    except MissingDataError:
-                        logger.error(f"failed to retrieve problem #{problem_id}")
+            if recent_problem_ids:
+                latest_problem_id = max(recent_problem_ids)
+                self._run(self._fetch_all(list(range(1, latest_problem_id + 1))))
 
     def command_render(self):
-        document_builder = DocumentBuilder(is_spaced=self._args.spaced)
+        latex_cache_path = self._output_path / "latex_cache"
+        document_builder = DocumentBuilder(
+            is_spaced=self._args.spaced, latex_cache_path=latex_cache_path
+        )
 
-        problem_id = None
-        problem_ids = list(self.iterate_problem_ids())
-        problem_count = len(problem_ids) if problem_ids else None
+        source_mod_paths = {
+            source_mod_path.stem: source_mod_path
+            for source_mod_path in (Path(__file__).parent / "../source_mods")
+            .resolve()
+            .glob("*.tex")
+        }
 
-        explicit_problem_ids = bool(problem_ids)
+        problem_sources = list(self.iterate_problem_sources(source_mod_paths))
 
-        with tqdm(desc="Rendering problems...", total=problem_count) as progress_bar:
-            while not explicit_problem_ids or problem_ids:
-                if explicit_problem_ids:
-                    problem_id = problem_ids.pop(0)
-                elif problem_id is None:
-                    problem_id = 1
-                else:
-                    problem_id += 1
+        # Workers skip the pandoc server if it is unavailable here, avoiding repeated
+        # startup attempts and warnings per worker:
+        pool_initializer = (
+            None if get_shared_pandoc_server() else disable_shared_pandoc_server
+        )
 
-                source_mod_path = (
-                    Path(__file__).parent / "../source_mods" / f"{problem_id}.tex"
-                )
+        # Problems are rendered independently in worker processes and appended in order:
+        with ProcessPoolExecutor(initializer=pool_initializer) as executor:
+            rendered_problems = executor.map(
+                functools.partial(render_problem, latex_cache_path=latex_cache_path),
+                [
+                    problem_id
+                    for problem_id, _, problem_html in problem_sources
+                    if problem_html is not None
+                ],
+                [
+                    problem_html
+                    for _, _, problem_html in problem_sources
+                    if problem_html is not None
+                ],
+            )
 
-                if source_mod_path.exists():
-                    source_mod_latex = source_mod_path.read_text()
+            for _, source_mod_latex, _ in tqdm(
+                problem_sources, desc="Rendering problems..."
+            ):
+                if source_mod_latex is not None:
                     document_builder.append_problem_latex_content(source_mod_latex)
                 else:
-                    # Intentionally only check cache, as we wish to receive None when there are no more problems:
-                    problem_data = self._retrieve_http_data(
-                        f"problem={problem_id}", cache_only=True
-                    )
-
-                    if not problem_data:
-                        break
-
-                    problem_html = problem_data.decode("utf8")
-                    document_builder.process_problem_html(problem_id, problem_html)
-
-                progress_bar.update(1)
+                    document_builder.append_rendered_problem(next(rendered_problems))
+
+        # Links are parsed in bulk; appendixes are discovered from problem content:
+        document_builder.parse_output_latex_links()
+
+        about_datas = self._retrieve_many_http_data(
+            [
+                about_url_path
+                for about_url_path in document_builder._url_paths_about
+                if _snake_case(about_url_path) not in source_mod_paths
+            ],
+            cache_only=self._args.cache_only,
+            force=self._args.force,
+        )
 
         for about_url_path in tqdm(
             document_builder._url_paths_about, "Rendering appendixes..."
         ):
-            source_mod_path = (
-                Path(__file__).parent
-                / "../source_mods"
-                / f"{pydash.snake_case(about_url_path)}.tex"
-            )
-
-            if source_mod_path.exists():
+            if source_mod_path := source_mod_paths.get(_snake_case(about_url_path)):
                 source_mod_latex = source_mod_path.read_text()
                 document_builder.append_about_latex_content(source_mod_latex)
             else:
-                about_html = self._retrieve_http_data(
-                    about_url_path,
-                    cache_only=self._args.cache_only,
-                    force=self._args.force,
-                ).decode("utf8")
+                about_html = about_datas[about_url_path].decode("utf8")
 
                 document_builder.process_about_html(about_url_path, about_html)
 
-        animated_resources = []
+        # Parse again to include resources and embedded files linked from appendixes:
+        document_builder.parse_output_latex_links()
+
+        gif_resources = []
+
+        resource_datas = self._retrieve_many_http_data(
+            list(document_builder._url_paths_resources),
+            cache_only=self._args.cache_only,
+            force=self._args.force,
+        )
 
         for resource_url_path in tqdm(
             document_builder._url_paths_resources, "Processing resources..."
         ):
-            _, resource_file_path = self._write_http_resource(
+            resource_file_path = self._write_http_resource(
                 resource_url_path,
+                resource_datas[resource_url_path],
                 store_in_base=False,
-                cache_only=self._args.cache_only,
-                force=self._args.force,
             )
 
             if resource_file_path.suffix == ".gif":
-                gif_frame_count = int(
-                    subprocess.run(
-                        ["identify", "-format", r"%n\n", str(resource_file_path)],
-                        capture_output=True,
-                        text=True,
-                    ).stdout.splitlines()[0]
-                )
-
-                subprocess.run(
-                    [
-                        "convert",
-                        "-coalesce",
-                        "-despeckle",
-                        str(resource_file_path),
-                        str(resource_file_path.with_suffix(".png")),
-                    ]
-                )
+                gif_resources.append((resource_url_path, resource_file_path))
 
-                animated_resources.append(
-                    dict(
-                        url_path=resource_url_path,
-                        file_path=resource_file_path.relative_to(self._output_path),
-                        frame_count=gif_frame_count,
-                    )
+        # Conversions run as independent subprocesses and can overlap in threads:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            animated_resource_futures = [
+                executor.submit(
+                    self._convert_gif_resource, resource_url_path, resource_file_path
                 )
+                for resource_url_path, resource_file_path in gif_resources
+            ]
+            animated_resources = [
+                animated_resource_future.result()
+                for animated_resource_future in animated_resource_futures
+            ]
+
+        embed_datas = self._retrieve_many_http_data(
+            list(document_builder._url_paths_embedded),
+            cache_only=self._args.cache_only,
+            force=self._args.force,
+        )
 
         for embed_url_path in document_builder._url_paths_embedded:
             self._write_http_resource(
-                embed_url_path,
-                store_in_base=True,
-                cache_only=self._args.cache_only,
-                force=self._args.force,
+                embed_url_path, embed_datas[embed_url_path], store_in_base=True
             )
 
         document_builder.process_animated_resources(animated_resources)
@@ -200,6 +312,32 @@ class ProjectEulerOfflineApp:
                 cwd=str(self._output_path),
             )
 
+    def iterate_problem_sources(self, source_mod_paths):
+        problem_ids = list(self.iterate_problem_ids())
+        candidate_problem_ids = iter(problem_ids) if problem_ids else itertools.count(1)
+
+        # Problems are looked up from the cache in batches, in order:
+        while problem_id_batch := list(
+            itertools.islice(candidate_problem_ids, self.RENDER_LOOKUP_BATCH_SIZE)
+        ):
+            # Intentionally only check cache, as we wish to receive None when there are no more problems:
+            problem_datas = self._retrieve_many_http_data(
+                [
+                    f"problem={problem_id}"
+                    for problem_id in problem_id_batch
+                    if str(problem_id) not in source_mod_paths
+                ],
+                cache_only=True,
+            )
+
+            for problem_id in problem_id_batch:
+                if source_mod_path := source_mod_paths.get(str(problem_id)):
+                    yield problem_id, source_mod_path.read_text(), None
+                elif problem_data := problem_datas.get(f"problem={problem_id}"):
+                    yield problem_id, None, problem_data.decode("utf8")
+                else:
+                    return
+
     def iterate_problem_ids(self):
         if self._args.problems:
             for problem_group in self._args.problems.split(","):
@@ -228,9 +366,17 @@ class ProjectEulerOfflineApp:
         self._args = parser.parse_args()
         self._output_path = Path(self._args.output_path)
 
-        self._http_cache = HttpDocumentCache(self._output_path / "http_cache.sqlite3")
+        self._event_loop = asyncio.new_event_loop()
+        self._http_cache = HttpDocumentCache(
+            self._output_path / "http_cache.sqlite3",
+            connection_limit=self.FETCH_CONCURRENCY,
+        )
 
-        if self._args.command == "fetch":
-            self.command_fetch()
-        elif self._args.command == "render":
-            self.command_render()
+        try:
+            if self._args.command == "fetch":
+                self.command_fetch()
+            elif self._args.command == "render":
+                self.command_render()
+        finally:
+            self._event_loop.run_until_complete(self._http_cache.close())
+            self._event_loop.close()
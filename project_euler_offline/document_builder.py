@@ -1,3 +1,8 @@
+import functools
+import hashlib
+import html
+import json
+import os
 import re
 from collections import defaultdict
 from pathlib import Path
@@ -5,7 +10,9 @@ from string import Template
 
 import pandoc
 import pandoc.types
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+from project_euler_offline.pandoc_server import get_shared_pandoc_server
 
 LATEX_BLOCK_STYLES = {
     "center": {
@@ -52,6 +59,9 @@ LATEX_CHARACTER_SUBSTITUTIONS = {
     "ω": r"\ensuremath{ω}",
 }
 
+# Substituted characters are single code points, allowing a single translate pass:
+_LATEX_CHARACTER_TRANSLATION = str.maketrans(LATEX_CHARACTER_SUBSTITUTIONS)
+
 LATEX_INLINE_STYLES = {
     "blue": {
         "pre": r"{\color{blue}",
@@ -105,6 +115,60 @@ LATEX_INLINE_STYLES = {
 
 LATEX_TEXTATTACHFILE_LINK_COLOR = "linkcolor"
 
+# Bump when HTML to LaTeX transform rules change to invalidate cached output:
+LATEX_CACHE_VERSION = 1
+
+_RE_ABOUT_TITLE = re.compile(r"About...\s*(?P<about_title>.*)")
+_RE_ALIGN_POST = re.compile(
+    r"(?P<end_env>\\end{((align(ed)?)|equation)\*?})\s*((\$\$?)|(\\\]))",
+    re.DOTALL | re.MULTILINE,
+)
+_RE_ALIGN_PRE = re.compile(
+    r"((\$\$?)|(\\\[))\s*(?P<begin_env>\\begin{((align(ed)?)|equation)\*?})",
+    re.DOTALL | re.MULTILINE,
+)
+_RE_ENV_STAR = re.compile(
+    r"\\(?P<begin_end>(begin|end)){(?P<env_type>(align|equation))}"
+)
+_RE_HREF = re.compile(r"\\href{(?P<href_target>[^}]+)}{(?P<href_label>[^}]+)}")
+_RE_INCLUDEGRAPHICS = re.compile(
+    r"\\includegraphics(\[(?P<options>[^\]]*)\])?{(?P<path>[^}]+)}"
+)
+# Display math is listed first so that `$$...$$` is preferred over `$...$`:
+_RE_MATH = re.compile(
+    r"\$\$[^$]+?\$\$|\$[^$]+?\$|\\\[.*?\\\]", re.DOTALL | re.MULTILINE
+)
+_RE_SOLO_IMG = re.compile(
+    r"(?P<space_pre>\s\s+)\\includegraphics(?P<options>\[[^\]]*\])?{(?P<name>.*?)}(\\\\)?(?P<space_post>\s\s+)",
+    re.DOTALL | re.MULTILINE,
+)
+_RE_TITLE = re.compile(
+    r"<title>\s*#(?P<problem_id>\d+)\s+(?P<problem_name>.*?) - Project Euler\s*</title>",
+    re.DOTALL,
+)
+
+_RE_STYLE_ALIGN_CENTER = re.compile(r"text-align:\s*center")
+_RE_STYLE_COLOR = re.compile(r"color:\s*#?(?P<color_value>[^;\s]+)")
+_RE_STYLE_FONT_FAMILY = re.compile(r"font-family:[^;]*(courier new|monospace)")
+_RE_STYLE_FONT_LARGER = re.compile(r"font-size:\s*larger")
+_RE_STYLE_FONT_SMALLER = re.compile(r"font-size:\s*smaller")
+_RE_STYLE_ITALIC = re.compile(r"font-style:\s*italic")
+_RE_STYLE_STRONG = re.compile(r"font-weight:\s*bold")
+_RE_STYLE_UNDERLINE = re.compile(r"text-decoration:\s*underline")
+
+# Links are resolved in a single pass, with alternatives in order of precedence:
+_RE_WRITE_LINKS = re.compile(
+    "|".join(
+        [
+            r"(?P<embed_link>\\href{(?P<href_url_path_base>[^\s}]*?)(?P<href_filename>[^\/}]*?.txt)}{(?P<href_label>[^}]*?)})",
+            r"""(?P<save_link_note>\s*\(right\s+click\s+and\s+['"]Save\s+Link/Target\s+As...['"]\)\s*)""",
+            r"(?P<problem_link>\\href{problem=(?P<problem_id>\d+)}{(?P<problem_href_target>[^}]*?)})",
+            r"(?P<about_link>\\href{about=(?P<about_id>[^}]+)}{(?P<about_href_target>[^}]*?)})",
+        ]
+    ),
+    re.DOTALL | re.MULTILINE,
+)
+
 
 def extract_page_title(soup):
     for header_type in range(1, 6 + 1):
@@ -113,9 +177,74 @@ def extract_page_title(soup):
             return header.extract()
 
 
+def iter_pandoc_with_ancestors(document):
+    # Equivalent to pandoc.iter(document, path=True) in pre-order, but ancestors are
+    # shared as a linked (parent, ancestors) chain rather than copied per element:
+    stack = [(document, None)]
+
+    while stack:
+        elt, ancestors = stack.pop()
+        yield elt, ancestors
+
+        if isinstance(elt, dict):
+            children = list(elt.items())
+        elif hasattr(elt, "__iter__") and not isinstance(elt, pandoc.types.String):
+            children = list(elt)
+        else:
+            continue
+
+        child_ancestors = (elt, ancestors)
+        stack.extend((child, child_ancestors) for child in reversed(children))
+
+
+def match_pandoc_block_classes(ancestors):
+    while ancestors is not None:
+        parent, ancestors = ancestors
+
+        if isinstance(parent, pandoc.types.Div):
+            return parent[0][1]
+        elif isinstance(parent, (pandoc.types.Para, pandoc.types.Plain)):
+            break
+        elif not isinstance(parent, (pandoc.types.BlockQuote, list)):
+            break
+
+
+@functools.lru_cache(maxsize=4096)
+def style_to_classes(style_lower):
+    # Inline styles repeat heavily across problems, so results are memoized:
+    classes = set()
+
+    if color := _RE_STYLE_COLOR.match(style_lower):
+        classes.add(f"__COLOR__{color.group('color_value')}")
+
+    if _RE_STYLE_FONT_FAMILY.search(style_lower):
+        classes.add("monospace")
+
+    if _RE_STYLE_FONT_LARGER.search(style_lower):
+        classes.add("larger")
+
+    if _RE_STYLE_FONT_SMALLER.search(style_lower):
+        classes.add("smaller")
+
+    if _RE_STYLE_ITALIC.search(style_lower):
+        classes.add("italic")
+
+    if _RE_STYLE_STRONG.search(style_lower):
+        classes.add("strong")
+
+    if _RE_STYLE_ALIGN_CENTER.search(style_lower):
+        classes.add("center")
+
+    if _RE_STYLE_UNDERLINE.search(style_lower):
+        classes.add("underline")
+
+    return frozenset(classes)
+
+
 class DocumentBuilder:
-    def __init__(self, is_spaced):
+    def __init__(self, is_spaced, latex_cache_path=None):
         self._is_spaced = is_spaced
+        self._latex_cache_path = latex_cache_path
 
         self._color_mappings = {}
         self._classes = defaultdict(list)
@@ -123,8 +252,9 @@ class DocumentBuilder:
         self._url_paths_embedded = set()
         self._url_paths_resources = set()
 
-        self._output_latex_content = ""
-        self._output_html_debug = ""
+        # Collected as chunks and joined once to avoid quadratic concatenation:
+        self._output_latex_chunks = []
+        self._output_html_debug_chunks = []
         self._output_has_appendix = False
 
     def _build_latex_preamble(self):
@@ -137,34 +267,81 @@ class DocumentBuilder:
 
         return output_latex_preamble
 
+    def _read_pandoc_document(self, content_html):
+        if pandoc_server := get_shared_pandoc_server():
+            # Reading JSON is handled in-process by the pandoc module:
+            return pandoc.read(
+                pandoc_server.convert(content_html, "html", "json"),
+                format="json",
+            )
+
+        return pandoc.read(content_html, format="html")
+
     def _transform_html_tag_class_info(self, soup, tag):
         for block_tag_name in ["p", "blockquote"]:
-            block_tags = [
-                block_tag
-                for block_tag in tag.find_all(block_tag_name)
-                if block_tag.get("class") or block_tag.get("style")
-            ]
-
-            for block_tag in block_tags:
+            for block_tag in tag.select(
+                f"{block_tag_name}[class], {block_tag_name}[style]"
+            ):
                 # Add class info to wrapped div to make it available in pandoc structure:
                 classes = set(
                     block_tag.get("class", [])
                 ) | self._transform_style_to_classes(block_tag.get("style", ""))
 
+                # Sorted so the serialized HTML, and thereby the cache key, is stable across runs:
                 if classes:
-                    block_tag.wrap(soup.new_tag("div", attrs={"class": list(classes)}))
-
-        for span_tag in tag.find_all("span"):
-            if style := span_tag.get("style"):
-                # Add class info to span to make it available in pandoc structure:
-                span_tag["class"] = list(
-                    set(span_tag.get("class", []))
-                    | self._transform_style_to_classes(style)
-                )
+                    block_tag.wrap(
+                        soup.new_tag("div", attrs={"class": sorted(classes)})
+                    )
+
+        for span_tag in tag.select('span[style]:not([style=""])'):
+            # Add class info to span to make it available in pandoc structure:
+            span_tag["class"] = sorted(
+                set(span_tag.get("class", []))
+                | self._transform_style_to_classes(span_tag["style"])
+            )
 
         return tag
 
     def _transform_html_to_latex(self, content_html):
+        if self._latex_cache_path is None:
+            document_latex, color_mappings = self._render_html_to_latex(content_html)
+        else:
+            cache_key = hashlib.sha256(
+                "|".join(
+                    [
+                        str(LATEX_CACHE_VERSION),
+                        pandoc.configure(read=True)["version"],
+                        content_html,
+                    ]
+                ).encode("utf8")
+            ).hexdigest()
+            cache_file_path = self._latex_cache_path / f"{cache_key}.json"
+
+            if cache_file_path.exists():
+                cache_entry = json.loads(cache_file_path.read_text())
+                document_latex = cache_entry["latex"]
+                color_mappings = cache_entry["color_mappings"]
+            else:
+                document_latex, color_mappings = self._render_html_to_latex(
+                    content_html
+                )
+
+                # Write through a temporary file as worker processes share the cache:
+                self._latex_cache_path.mkdir(parents=True, exist_ok=True)
+                cache_temp_path = cache_file_path.with_suffix(f".{os.getpid()}.tmp")
+                cache_temp_path.write_text(
+                    json.dumps(
+                        {"latex": document_latex, "color_mappings": color_mappings}
+                    )
+                )
+                cache_temp_path.replace(cache_file_path)
+
+        self._color_mappings.update(color_mappings)
+
+        return document_latex
+
+    def _render_html_to_latex(self, content_html):
+        color_mappings = {}
         latex_substitutions = {}
 
         def replace_with_marker(match):
@@ -173,18 +350,11 @@ class DocumentBuilder:
             latex_substitutions[marker] = match.group(0)
             return marker
 
-        content_html = re.sub(r"\$\$[^$]+?\$\$", replace_with_marker, content_html)
-        content_html = re.sub(r"\$[^$]+?\$", replace_with_marker, content_html)
-        content_html = re.sub(
-            r"\\\[.*?\\\]",
-            replace_with_marker,
-            content_html,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        content_html = _RE_MATH.sub(replace_with_marker, content_html)
 
-        document_pandoc = pandoc.read(content_html, format="html")
-        self._transform_pandoc_document(document_pandoc)
-        document_latex = str(pandoc.write(document_pandoc, format="latex").strip())
+        document_pandoc = self._read_pandoc_document(content_html)
+        self._transform_pandoc_document(document_pandoc, color_mappings)
+        document_latex = str(self._write_pandoc_document(document_pandoc).strip())
 
         for marker, substitution in latex_substitutions.items():
             substitution = substitution.replace("&amp;", r"&")
@@ -193,58 +363,40 @@ class DocumentBuilder:
             document_latex = document_latex.replace(marker, substitution)
 
         # Prevent issue with align environement wrapped in math env:
-        document_latex = re.sub(
-            r"((\$\$?)|(\\\[))\s*(?P<begin_env>\\begin{((align(ed)?)|equation)\*?})",
-            "\g<begin_env>",
-            document_latex,
-            flags=re.DOTALL | re.MULTILINE,
-        )
-        document_latex = re.sub(
-            r"(?P<end_env>\\end{((align(ed)?)|equation)\*?})\s*((\$\$?)|(\\\]))",
-            "\g<end_env>",
-            document_latex,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        document_latex = _RE_ALIGN_PRE.sub(r"\g<begin_env>", document_latex)
+        document_latex = _RE_ALIGN_POST.sub(r"\g<end_env>", document_latex)
 
         # Ensure non-numbered align and equation envs:
-        document_latex = re.sub(
-            r"\\(?P<begin_end>(begin|end)){(?P<env_type>(align|equation))}",
-            "\\\\\g<begin_end>{\g<env_type>*}",
-            document_latex,
+        document_latex = _RE_ENV_STAR.sub(
+            r"\\\g<begin_end>{\g<env_type>*}", document_latex
         )
 
         # Set solo image centering:
-        document_latex = re.sub(
-            r"(?P<space_pre>\s\s+)\\includegraphics(?P<options>\[[^\]]*\])?{(?P<name>.*?)}(\\\\)?(?P<space_post>\s\s+)",
+        document_latex = _RE_SOLO_IMG.sub(
             r"\g<space_pre>\\begin{center}\\includegraphics\g<options>{\g<name>}\\end{center}\g<space_post>",
             document_latex,
-            flags=re.DOTALL | re.MULTILINE,
         )
 
-        return document_latex
+        return document_latex, color_mappings
 
-    def _transform_pandoc_document(self, document):
-        self._transform_pandoc_document_inline_elements(document)
-        self._transform_pandoc_document_block_elements(document)
-
-    def _transform_pandoc_document_block_elements(self, document):
-        def match_block_classes(elt, path):
-            if isinstance(elt, (pandoc.types.Para, pandoc.types.Plain)):
-                for parent, _ in path[::-1]:
-                    if isinstance(parent, pandoc.types.Div):
-                        return parent[0][1]
-                    elif isinstance(parent, (pandoc.types.Para, pandoc.types.Plain)):
-                        break
-                    elif not isinstance(parent, (pandoc.types.BlockQuote, list)):
-                        break
-
-        matches = [
-            (elt, path, classes)
-            for (elt, path) in pandoc.iter(document, path=True)
-            if (classes := match_block_classes(elt, path))
-        ]
+    def _transform_pandoc_document(self, document, color_mappings):
+        block_matches = []
+        inline_matches = []
 
-        for elt, _, classes in reversed(matches):
+        # Collect both kinds of matches in a single traversal of the document:
+        for elt, ancestors in iter_pandoc_with_ancestors(document):
+            if isinstance(elt, pandoc.types.Span):
+                if classes := elt[0][1]:
+                    inline_matches.append((elt, classes))
+            elif isinstance(elt, (pandoc.types.Para, pandoc.types.Plain)):
+                if classes := match_pandoc_block_classes(ancestors):
+                    block_matches.append((elt, classes))
+
+        self._transform_pandoc_document_inline_elements(inline_matches, color_mappings)
+        self._transform_pandoc_document_block_elements(block_matches)
+
+    def _transform_pandoc_document_block_elements(self, matches):
+        for elt, classes in reversed(matches):
             for cls in classes:
                 if transform := LATEX_INLINE_STYLES.get(cls):
                     if post := transform.get("post"):
@@ -261,18 +413,8 @@ class DocumentBuilder:
                     if pre := transform.get("pre"):
                         elt[0].insert(0, pandoc.types.RawInline("latex", pre))
 
-    def _transform_pandoc_document_inline_elements(self, document):
-        def match_inline_classes(elt, path):
-            if isinstance(elt, pandoc.types.Span):
-                return elt[0][1]
-
-        matches = [
-            (elt, path, classes)
-            for (elt, path) in pandoc.iter(document, path=True)
-            if (classes := match_inline_classes(elt, path))
-        ]
-
-        for elt, _, classes in reversed(matches):
+    def _transform_pandoc_document_inline_elements(self, matches, color_mappings):
+        for elt, classes in reversed(matches):
             for cls in classes:
                 if transform := LATEX_INLINE_STYLES.get(cls):
                     if post := transform.get("post"):
@@ -283,11 +425,9 @@ class DocumentBuilder:
                 elif cls.startswith("__COLOR__"):
                     color = cls.removeprefix("__COLOR__")
 
-                    if color in self._color_mappings:
-                        color_name = self._color_mappings[color]
-                    else:
-                        color_name = f"CustomColor{len(self._color_mappings)}"
-                        self._color_mappings[color] = color_name
+                    # Derive name from value so that separately rendered problems agree:
+                    color_name = f"CustomColor{color.upper()}"
+                    color_mappings[color] = color_name
 
                     elt[1].append(pandoc.types.RawInline("latex", "}"))
                     elt[1].insert(
@@ -295,35 +435,15 @@ class DocumentBuilder:
                     )
 
     def _transform_style_to_classes(self, style):
-        classes = set()
-
-        style_lower = style.lower()
-
-        if color := re.match("color:\s*#?(?P<color_value>[^;\s]+)", style_lower):
-            classes.add(f"__COLOR__{color.group('color_value')}")
-
-        if re.search("font-family:[^;]*(courier new|monospace)", style_lower):
-            classes.add("monospace")
-
-        if re.search("font-size:\s*larger", style_lower):
-            classes.add("larger")
-
-        if re.search("font-size:\s*smaller", style_lower):
-            classes.add("smaller")
+        return style_to_classes(style.lower())
 
-        if re.search("font-style:\s*italic", style_lower):
-            classes.add("italic")
-
-        if re.search("font-weight:\s*bold", style_lower):
-            classes.add("strong")
-
-        if re.search("text-align:\s*center", style_lower):
-            classes.add("center")
-
-        if re.search("text-decoration:\s*underline", style_lower):
-            classes.add("underline")
+    def _write_pandoc_document(self, document):
+        if pandoc_server := get_shared_pandoc_server():
+            return pandoc_server.convert(
+                pandoc.write(document, format="json"), "json", "latex"
+            )
 
-        return classes
+        return pandoc.write(document, format="latex")
 
     def append_about_latex_content(self, about_content_latex):
         if not self._output_has_appendix:
@@ -342,8 +462,7 @@ class DocumentBuilder:
         self.append_latex_content("\n\n")
 
     def append_latex_content(self, latex_content):
-        self.parse_latex_links(latex_content)
-        self._output_latex_content += latex_content
+        self._output_latex_chunks.append(latex_content)
 
     def append_latex_content_page(self, latex_content):
         if self._is_spaced:
@@ -356,15 +475,11 @@ class DocumentBuilder:
         self.append_latex_content("\n\n")
 
     def parse_latex_links(self, content):
-        for graphics_match in re.finditer(
-            r"\\includegraphics(\[[^\]]*\])?{(?P<path>[^}]+)}", content
-        ):
+        for graphics_match in _RE_INCLUDEGRAPHICS.finditer(content):
             graphics_path = graphics_match.group("path")
             self._url_paths_resources.add(graphics_path)
 
-        for href_match in re.finditer(
-            r"\\href{(?P<href_target>[^}]+)}{(?P<href_label>[^}]+)}", content
-        ):
+        for href_match in _RE_HREF.finditer(content):
             href_target = href_match.group("href_target")
 
             if href_target.endswith(".txt"):
@@ -372,6 +487,9 @@ class DocumentBuilder:
             elif href_target.startswith("about="):
                 self._url_paths_about.add(href_target)
 
+    def parse_output_latex_links(self):
+        self.parse_latex_links("".join(self._output_latex_chunks))
+
     def parse_problem_html_soup(self, soup, problem_id):
         for tag in soup.find_all():
             classes = tag.get("class", [])
@@ -380,13 +498,13 @@ class DocumentBuilder:
                 self._classes[class_].append(problem_id)
 
     def process_about_html(self, about_url_path, about_html):
-        about_soup = BeautifulSoup(about_html, "html.parser")
+        about_soup = BeautifulSoup(
+            about_html, "lxml", parse_only=SoupStrainer(id="about_page")
+        )
         about_content_tag = about_soup.find(id="about_page")
 
-        about_title = re.sub(
-            "About...\s*(?P<about_title>.*)",
-            r"\g<about_title>",
-            extract_page_title(about_content_tag).text,
+        about_title = _RE_ABOUT_TITLE.sub(
+            r"\g<about_title>", extract_page_title(about_content_tag).text
         )
 
         about_content_latex = (
@@ -425,14 +543,16 @@ class DocumentBuilder:
             else:
                 return match.group(0)
 
-        self._output_latex_content = re.sub(
-            r"\\includegraphics(\[(?P<options>[^\]]*)\])?{(?P<path>[^}]+)}",
-            transform_animated_resource,
-            self._output_latex_content,
-        )
+        self._output_latex_chunks = [
+            _RE_INCLUDEGRAPHICS.sub(
+                transform_animated_resource, "".join(self._output_latex_chunks)
+            )
+        ]
 
-    def process_problem_html(self, problem_id, problem_html):
-        problem_soup = BeautifulSoup(problem_html, "html.parser")
+    def _render_problem_html(self, problem_id, problem_html):
+        problem_soup = BeautifulSoup(
+            problem_html, "lxml", parse_only=SoupStrainer(class_="problem_content")
+        )
         problem_content_soup_tag = problem_soup.find(class_="problem_content")
 
         self.parse_problem_html_soup(problem_content_soup_tag, problem_id)
@@ -441,11 +561,8 @@ class DocumentBuilder:
         )
         problem_content_html = str(problem_content_soup_tag)
 
-        title_match = re.match(
-            "^#(?P<problem_id>\d+)\s+(?P<problem_name>.*?) - Project Euler$",
-            problem_soup.title.text,
-        )
-        problem_title = f"{title_match.group('problem_name')}"
+        title_match = _RE_TITLE.search(problem_html)
+        problem_title = html.unescape(title_match.group("problem_name"))
 
         # TODO: Problem ID in section numbering should be explicit
         # TODO: Problem title should link to problem URL
@@ -455,45 +572,48 @@ class DocumentBuilder:
             + self._transform_html_to_latex(problem_content_html)
         )
 
-        self.append_problem_latex_content(problem_content_latex)
+        return problem_content_latex, problem_content_html
 
-        self._output_html_debug += f"<!-- Problem {problem_id} -->\n\n"
-        self._output_html_debug += problem_content_html + "\n\n"
+    def append_rendered_problem(self, rendered_problem):
+        for class_, problem_ids in rendered_problem["classes"].items():
+            self._classes[class_].extend(problem_ids)
 
-    def write(self, output_path, build_name):
-        output_latex_content = self._output_latex_content
-
-        # Resolve internal embedded files:
-        output_latex_content = re.sub(
-            r"\\href{(?P<href_url_path_base>[^\s}]*?)(?P<href_filename>[^\/}]*?.txt)}{(?P<href_label>[^}]*?)}",
-            rf"\\textattachfile[color={LATEX_TEXTATTACHFILE_LINK_COLOR}]{{\g<href_filename>}}{{\g<href_label>}}\\footnote{{Source: \\url{{https://projecteuler.net/\g<href_url_path_base>\g<href_filename>}}}}",
-            output_latex_content,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        self._color_mappings.update(rendered_problem["color_mappings"])
 
-        output_latex_content = re.sub(
-            r"""\s*\(right\s+click\s+and\s+['"]Save\s+Link/Target\s+As...['"]\)\s*""",
-            "",
-            output_latex_content,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        self.append_problem_latex_content(rendered_problem["latex"])
 
-        # Resolve internal problem links:
-        output_latex_content = re.sub(
-            r"\\href{problem=(?P<problem_id>\d+)}{(?P<href_target>[^}]*?)}",
-            r"\\hyperref[sec:problem_\g<problem_id>]{\g<href_target>}",
-            output_latex_content,
-            flags=re.DOTALL | re.MULTILINE,
+        self._output_html_debug_chunks.append(
+            f"<!-- Problem {rendered_problem['problem_id']} -->\n\n"
         )
+        self._output_html_debug_chunks.append(rendered_problem["html"] + "\n\n")
 
-        # Resolve internal about links:
-        output_latex_content = re.sub(
-            r"\\href{about=(?P<about_id>[^}]+)}{(?P<href_target>[^}]*?)}",
-            lambda x: rf"\hyperref[sec:about={x.group('about_id')}]{{{x.group('href_target')}}}",
-            output_latex_content,
-            flags=re.DOTALL | re.MULTILINE,
+    def process_problem_html(self, problem_id, problem_html):
+        self.append_rendered_problem(
+            render_problem(problem_id, problem_html, self._latex_cache_path)
         )
 
+    def write(self, output_path, build_name):
+        output_latex_content = "".join(self._output_latex_chunks)
+
+        def resolve_link(match):
+            if match.lastgroup == "embed_link":
+                # Resolve internal embedded files:
+                return match.expand(
+                    rf"\\textattachfile[color={LATEX_TEXTATTACHFILE_LINK_COLOR}]{{\g<href_filename>}}{{\g<href_label>}}\\footnote{{Source: \\url{{https://projecteuler.net/\g<href_url_path_base>\g<href_filename>}}}}"
+                )
+            elif match.lastgroup == "save_link_note":
+                return ""
+            elif match.lastgroup == "problem_link":
+                # Resolve internal problem links:
+                return match.expand(
+                    r"\\hyperref[sec:problem_\g<problem_id>]{\g<problem_href_target>}"
+                )
+            else:
+                # Resolve internal about links:
+                return rf"\hyperref[sec:about={match.group('about_id')}]{{{match.group('about_href_target')}}}"
+
+        output_latex_content = _RE_WRITE_LINKS.sub(resolve_link, output_latex_content)
+
         template_path = Path(__file__).parent / "template.tex"
         template = Template(template_path.read_text())
 
@@ -502,8 +622,7 @@ class DocumentBuilder:
             content=output_latex_content,
         )
 
-        for character, substitution in LATEX_CHARACTER_SUBSTITUTIONS.items():
-            output_latex = output_latex.replace(character, substitution)
+        output_latex = output_latex.translate(_LATEX_CHARACTER_TRANSLATION)
 
         output_latex_path = output_path / (build_name + ".tex")
         output_latex_path.write_text(output_latex)
@@ -516,6 +635,27 @@ class DocumentBuilder:
             )
         )
 
-        (output_path / "debug_output.html").write_text(self._output_html_debug)
+        (output_path / "debug_output.html").write_text(
+            "".join(self._output_html_debug_chunks)
+        )
 
         return output_latex_path
+
+
+def render_problem(problem_id, problem_html, latex_cache_path=None):
+    # Render with a fresh builder so that the result only depends on the input,
+    # allowing problems to be rendered in worker processes:
+    document_builder = DocumentBuilder(
+        is_spaced=False, latex_cache_path=latex_cache_path
+    )
+    problem_content_latex, problem_content_html = document_builder._render_problem_html(
+        problem_id, problem_html
+    )
+
+    return dict(
+        problem_id=problem_id,
+        latex=problem_content_latex,
+        html=problem_content_html,
+        classes=dict(document_builder._classes),
+        color_mappings=document_builder._color_mappings,
+    )
@@ -1,14 +1,18 @@
 #!/bin/env python
 
-import datetime
+import asyncio
+import collections
 import http
 import json
 import sqlite3
+import time
+import zlib
 
 import aiohttp
+import msgpack
 
 
-class DataRetrievalError(BaseException):
+class DataRetrievalError(Exception):
     pass
 
 
@@ -16,95 +20,410 @@ class MissingDataError(DataRetrievalError):
     pass
 
 
+# Plain integers avoid enum comparisons on every response:
+_HTTP_STATUS_FOUND = int(http.HTTPStatus.FOUND)
+_HTTP_STATUS_NOT_MODIFIED = int(http.HTTPStatus.NOT_MODIFIED)
+_HTTP_STATUS_OK = int(http.HTTPStatus.OK)
+
+# Response headers used to revalidate cached entries, and their request counterparts:
+_VALIDATION_HEADERS = {"etag": "If-None-Match", "last-modified": "If-Modified-Since"}
+
+
+def _adapt_dictionary(value):
+    return msgpack.packb(value)
+
+
+def _convert_dictionary(data):
+    # Entries written before switching to msgpack hold JSON objects:
+    if data[:1] == b"{":
+        return json.loads(data.decode("utf8"))
+
+    return msgpack.unpackb(data, raw=False)
+
+
+# Registered once per process as the sqlite3 adapters and converters are global:
+sqlite3.register_adapter(dict, _adapt_dictionary)
+sqlite3.register_converter("dictionary", _convert_dictionary)
+
+
+def _decode_response_data(response_data, response_encoding):
+    # Accepts both gzip and zlib wrapped deflate streams:
+    if response_encoding in ("gzip", "deflate"):
+        return zlib.decompress(response_data, zlib.MAX_WBITS | 32)
+
+    return response_data
+
+
 class HttpDocumentCache:
-    def __init__(self, database_file_path):
+    INSERT_SQL = (
+        "insert or replace into http_cache(request_timestamp, request_url, request_headers, response_headers, response_data, response_encoding) "
+        + "values (:request_timestamp, :request_url, :request_headers, :response_headers, :response_data, :response_encoding)"
+    )
+    MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+    OPTIMIZE_INTERVAL = 900
+    SELECT_MANY_BATCH_SIZE = 500
+    SELECT_SQL = "select response_data, response_encoding from http_cache where request_url=:request_url limit 1"
+    VALIDATION_SELECT_SQL = "select response_data, response_encoding, response_headers from http_cache where request_url=:request_url limit 1"
+    WRITE_BATCH_SIZE = 64
+    WRITE_FLUSH_DELAY = 0.1
+
+    def __init__(self, database_file_path, connection_limit=10):
         self._database_file_path = database_file_path
         self._database_connection = self._setup_database(self._database_file_path)
 
-    def _setup_database(self, database_file_path):
-        database_file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Lookups use a separate read only connection, which WAL lets run alongside writes:
+        if str(self._database_file_path) != ":memory:":
+            self._read_database_connection = self._connect_database(
+                self._database_file_path, read_only=True
+            )
+        else:
+            self._read_database_connection = self._database_connection
+
+        self._last_optimize_time = time.monotonic()
+        self._connection_limit = connection_limit
+        self._session = None
+
+        # Recently retrieved documents are kept in memory, bounded by total size:
+        self._memory_cache = collections.OrderedDict()
+        self._memory_cache_size = 0
+
+        # Fetched entries are written in batches to share one commit:
+        self._pending_writes = {}
+        self._pending_writes_flush_handle = None
+
+    def _get_session(self):
+        # Created lazily as the session must be bound to a running event loop:
+        if self._session is None:
+            # Responses are kept compressed as received and decoded on retrieval:
+            self._session = aiohttp.ClientSession(
+                auto_decompress=False,
+                connector=aiohttp.TCPConnector(
+                    limit=self._connection_limit, ttl_dns_cache=300
+                ),
+            )
+
+        return self._session
+
+    def _connect_database(self, database_file_path, read_only=False):
+        if read_only:
+            database_connection = sqlite3.connect(
+                database_file_path.resolve().as_uri() + "?mode=ro",
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=256,
+                uri=True,
+            )
+            database_connection.execute("pragma query_only=1")
+        else:
+            database_connection = sqlite3.connect(
+                str(database_file_path),
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=256,
+            )
 
-        database_connection = sqlite3.connect(
-            str(database_file_path), detect_types=sqlite3.PARSE_DECLTYPES
-        )
         database_connection.row_factory = sqlite3.Row
 
-        sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat())
-        sqlite3.register_adapter(
-            dict, lambda value: json.dumps(value, separators=(",", ":")).encode("utf8")
-        )
-        sqlite3.register_converter(
-            "datetime",
-            lambda data: datetime.datetime.fromisoformat(data.decode("utf8")),
-        )
-        sqlite3.register_converter(
-            "dictionary", lambda data: json.loads(data.decode("utf8"))
-        )
+        database_connection.execute("pragma busy_timeout=30000")
+
+        # Cache hits are served from a larger page cache and memory mapped pages:
+        database_connection.execute("pragma cache_size=-64000")
+        database_connection.execute("pragma mmap_size=268435456")
+        database_connection.execute("pragma temp_store=memory")
+
+        return database_connection
+
+    def _setup_database(self, database_file_path):
+        database_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        database_connection = self._connect_database(database_file_path)
 
         with database_connection:
             database_connection.execute(
                 """
                 create table if not exists http_cache 
-                (request_timestamp datetime, request_url text, request_headers dictionary, response_headers dictionary, response_data blob)
+                (request_timestamp integer, request_url text, request_headers dictionary, response_headers dictionary, response_data blob, response_encoding text)
             """
             )
 
+            if not any(
+                column["name"] == "response_encoding"
+                for column in database_connection.execute(
+                    "pragma table_info(http_cache)"
+                )
+            ):
+                database_connection.execute(
+                    "alter table http_cache add column response_encoding text"
+                )
+
+            if not database_connection.execute(
+                "select 1 from sqlite_master where type='index' and name='idx_http_cache_url'"
+            ).fetchone():
+                # Caches created before the index may hold duplicate entries; keep the latest:
+                database_connection.execute(
+                    "delete from http_cache where rowid not in (select max(rowid) from http_cache group by request_url)"
+                )
+                database_connection.execute(
+                    "create unique index idx_http_cache_url on http_cache(request_url)"
+                )
+
+        # WAL lets cached reads proceed while fresh responses are being inserted:
+        if str(database_file_path) != ":memory:":
+            database_connection.execute("pragma journal_mode=wal")
+            database_connection.execute("pragma synchronous=normal")
+
+        database_connection.execute("pragma optimize")
+
         return database_connection
 
+    def _optimize_periodically(self):
+        # Long lived connections should periodically refresh query planner statistics:
+        if time.monotonic() - self._last_optimize_time > self.OPTIMIZE_INTERVAL:
+            self._database_connection.execute("pragma optimize")
+            self._last_optimize_time = time.monotonic()
+
+    def _remember_data(self, request_url, response_data):
+        if (previous_data := self._memory_cache.pop(request_url, None)) is not None:
+            self._memory_cache_size -= len(previous_data)
+
+        if len(response_data) > self.MEMORY_CACHE_SIZE:
+            return
+
+        self._memory_cache[request_url] = response_data
+        self._memory_cache_size += len(response_data)
+
+        while self._memory_cache_size > self.MEMORY_CACHE_SIZE:
+            _, evicted_data = self._memory_cache.popitem(last=False)
+            self._memory_cache_size -= len(evicted_data)
+
+    def _store_data(self, cache_entry):
+        self._pending_writes[cache_entry["request_url"]] = cache_entry
+
+        if len(self._pending_writes) >= self.WRITE_BATCH_SIZE:
+            self.flush_pending_writes()
+        elif self._pending_writes_flush_handle is None:
+            self._pending_writes_flush_handle = asyncio.get_running_loop().call_later(
+                self.WRITE_FLUSH_DELAY, self.flush_pending_writes
+            )
+
+    def flush_pending_writes(self):
+        if self._pending_writes_flush_handle is not None:
+            self._pending_writes_flush_handle.cancel()
+            self._pending_writes_flush_handle = None
+
+        if not self._pending_writes:
+            return
+
+        with self._database_connection:
+            self._database_connection.executemany(
+                self.INSERT_SQL, self._pending_writes.values()
+            )
+
+        self._pending_writes = {}
+
+    def _lookup_data(self, request_url, select_sql=SELECT_SQL):
+        # Entries awaiting a batched write are not yet visible in the database:
+        if (cache_entry := self._pending_writes.get(request_url)) is not None:
+            return cache_entry
+
+        return self._read_database_connection.execute(
+            select_sql, {"request_url": request_url}
+        ).fetchone()
+
+    async def _fetch_data(
+        self, request_url, cache_disable, store_headers=False, cache_entry=None
+    ):
+        request_timestamp = int(time.time())
+
+        request_headers = {"Accept-Encoding": "gzip, deflate"}
+
+        # Revalidate an existing entry so unchanged documents are not transferred again:
+        if cache_entry is not None and cache_entry["response_headers"]:
+            request_headers.update(
+                (_VALIDATION_HEADERS[name.lower()], value)
+                for name, value in cache_entry["response_headers"].items()
+                if name.lower() in _VALIDATION_HEADERS
+            )
+
+        session = self._get_session()
+
+        async with session.get(request_url, headers=request_headers) as response:
+            if response.status == _HTTP_STATUS_OK:
+                response_encoding = response.headers.get("Content-Encoding")
+                response_data = await response.read()
+                decoded_response_data = _decode_response_data(
+                    response_data, response_encoding
+                )
+
+                if not decoded_response_data:
+                    raise MissingDataError(f"{request_url}: Missing response payload")
+
+                if not cache_disable:
+                    # Apart from validators, headers are only stored when explicitly requested:
+                    if store_headers:
+                        response_headers = dict(response.headers)
+                    else:
+                        response_headers = {
+                            name: value
+                            for name, value in response.headers.items()
+                            if name.lower() in _VALIDATION_HEADERS
+                        } or None
+
+                    self._store_data(
+                        {
+                            "request_timestamp": request_timestamp,
+                            "request_url": request_url,
+                            "request_headers": request_headers,
+                            "response_headers": response_headers,
+                            "response_data": response_data,
+                            "response_encoding": response_encoding,
+                        }
+                    )
+
+                return decoded_response_data
+            elif (
+                response.status == _HTTP_STATUS_NOT_MODIFIED and cache_entry is not None
+            ):
+                return _decode_response_data(
+                    cache_entry["response_data"], cache_entry["response_encoding"]
+                )
+            elif response.status == _HTTP_STATUS_FOUND:
+                raise MissingDataError(
+                    f"{request_url}: HTTP 302 (Object moved temporarily)"
+                )
+            else:
+                raise DataRetrievalError(f"{request_url}: HTTP {response.status}")
+
+    def _retrieve_cached(self, request_url):
+        if (response_data := self._memory_cache.get(request_url)) is not None:
+            self._memory_cache.move_to_end(request_url)
+            return response_data
+
+        cache_entry = self._lookup_data(request_url)
+
+        if cache_entry is not None:
+            if cache_entry["response_data"]:
+                response_data = _decode_response_data(
+                    cache_entry["response_data"], cache_entry["response_encoding"]
+                )
+                self._remember_data(request_url, response_data)
+                return response_data
+
+    async def _retrieve_cached_or_fetch(self, request_url, store_headers):
+        if (response_data := self._retrieve_cached(request_url)) is not None:
+            return response_data
+
+        response_data = await self._fetch_data(
+            request_url, cache_disable=False, store_headers=store_headers
+        )
+        self._remember_data(request_url, response_data)
+        return response_data
+
+    async def _retrieve_force_fetch(self, request_url, store_headers):
+        cache_entry = self._lookup_data(request_url, self.VALIDATION_SELECT_SQL)
+
+        response_data = await self._fetch_data(
+            request_url,
+            cache_disable=False,
+            store_headers=store_headers,
+            cache_entry=cache_entry,
+        )
+        self._remember_data(request_url, response_data)
+        return response_data
+
+    async def _retrieve_no_cache(self, request_url):
+        return await self._fetch_data(request_url, cache_disable=True)
+
     async def retrieve_data(
-        self, request_url, cache_disable=False, cache_only=False, force=False
+        self,
+        request_url,
+        cache_disable=False,
+        cache_only=False,
+        force=False,
+        store_headers=False,
     ):
-        if not cache_disable and not force:
-            cache_entry = next(
-                self._database_connection.execute(
-                    "select * from http_cache where request_url=:request_url",
-                    {"request_url": request_url},
+        self._optimize_periodically()
+
+        # Each combination of flags is served by a dedicated straight-line path:
+        if cache_disable:
+            if not cache_only:
+                return await self._retrieve_no_cache(request_url)
+        elif force:
+            if not cache_only:
+                return await self._retrieve_force_fetch(request_url, store_headers)
+        elif cache_only:
+            return self._retrieve_cached(request_url)
+        else:
+            return await self._retrieve_cached_or_fetch(request_url, store_headers)
+
+    async def retrieve_many(self, request_urls, cache_only=False):
+        self._optimize_periodically()
+
+        responses = {}
+        missing_request_urls = []
+
+        for request_url in dict.fromkeys(request_urls):
+            if (response_data := self._memory_cache.get(request_url)) is not None:
+                self._memory_cache.move_to_end(request_url)
+                responses[request_url] = response_data
+            else:
+                missing_request_urls.append(request_url)
+
+        self.flush_pending_writes()
+
+        # Look up entries in batches to stay below the SQLite variable limit:
+        for batch_start in range(
+            0, len(missing_request_urls), self.SELECT_MANY_BATCH_SIZE
+        ):
+            batch_request_urls = missing_request_urls[
+                batch_start : batch_start + self.SELECT_MANY_BATCH_SIZE
+            ]
+
+            cache_entries = self._read_database_connection.execute(
+                "select request_url, response_data, response_encoding from http_cache where request_url in ({})".format(
+                    ",".join("?" * len(batch_request_urls))
                 ),
-                None,
+                batch_request_urls,
             )
 
-            if cache_entry is not None:
-                if len(cache_entry["response_data"]) != 0:
-                    return cache_entry["response_data"]
+            for request_url, response_data, response_encoding in cache_entries:
+                if response_data:
+                    response_data = _decode_response_data(
+                        response_data, response_encoding
+                    )
+                    self._remember_data(request_url, response_data)
+                    responses[request_url] = response_data
 
         if not cache_only:
-            async with aiohttp.ClientSession() as session:
-                request_timestamp = datetime.datetime.now()
-
-                request_headers = {}
-
-                async with session.get(
-                    request_url, headers=request_headers
-                ) as response:
-                    if response.status == http.HTTPStatus.OK:
-                        response_headers = {k: v for k, v in response.headers.items()}
-                        response_data = await response.read()
-
-                        if not response_data or len(response_data) == 0:
-                            raise MissingDataError(
-                                f"{request_url}: Missing response payload"
-                            )
-
-                        if not cache_disable:
-                            with self._database_connection:
-                                self._database_connection.execute(
-                                    "insert into http_cache(request_timestamp, request_url, request_headers, response_headers, response_data) "
-                                    + "values (:request_timestamp, :request_url, :request_headers, :response_headers, :response_data)",
-                                    {
-                                        "request_timestamp": request_timestamp,
-                                        "request_url": request_url,
-                                        "request_headers": request_headers,
-                                        "response_headers": response_headers,
-                                        "response_data": response_data,
-                                    },
-                                )
-
-                        return response_data
-                    elif response.status == http.HTTPStatus.FOUND:
-                        raise MissingDataError(
-                            f"{request_url}: HTTP 302 (Object moved temporarily)"
-                        )
-                    else:
-                        raise DataRetrievalError(
-                            f"{request_url}: HTTP {response.status}"
-                        )
+            fetch_request_urls = [
+                request_url
+                for request_url in missing_request_urls
+                if request_url not in responses
+            ]
+
+            # Failed fetches are returned as their exceptions without discarding other results:
+            for request_url, response_data in zip(
+                fetch_request_urls,
+                await asyncio.gather(
+                    *(
+                        self._fetch_data(request_url, cache_disable=False)
+                        for request_url in fetch_request_urls
+                    ),
+                    return_exceptions=True,
+                ),
+            ):
+                if not isinstance(response_data, Exception):
+                    self._remember_data(request_url, response_data)
+
+                responses[request_url] = response_data
+
+        return responses
+
+    async def close(self):
+        try:
+            self.flush_pending_writes()
+        finally:
+            if self._session is not None:
+                await self._session.close()
+                self._session = None
+
+            self._read_database_connection.close()
+            self._database_connection.close()
@@ -0,0 +1,166 @@
+import json
+import logging
+import multiprocessing.util
+import re
+import shutil
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+_RE_PANDOC_VERSION = re.compile(r"^pandoc(?:\.exe)? (?P<major_version>\d+)\.")
+
+_shared_pandoc_server = None
+
+
+class PandocServerError(Exception):
+    pass
+
+
+class PandocServer:
+    CONVERSION_TIMEOUT = 120
+    MINIMUM_MAJOR_VERSION = 3
+    STARTUP_TIMEOUT = 10.0
+
+    def __init__(self, pandoc_path=None):
+        self._pandoc_path = pandoc_path or shutil.which("pandoc")
+        self._process = None
+        self._url = None
+
+        # The server is local, so requests must not be routed through a configured proxy:
+        self._url_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    def _find_free_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def _wait_until_ready(self, port):
+        deadline = time.monotonic() + self.STARTUP_TIMEOUT
+
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                return False
+
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    return True
+            except OSError:
+                time.sleep(0.05)
+
+        return False
+
+    def is_supported(self):
+        # The server mode is only available from pandoc 3:
+        if not self._pandoc_path:
+            return False
+
+        try:
+            version_output = subprocess.run(
+                [self._pandoc_path, "--version"],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return False
+
+        version_match = _RE_PANDOC_VERSION.match(version_output)
+
+        return bool(version_match) and (
+            int(version_match.group("major_version")) >= self.MINIMUM_MAJOR_VERSION
+        )
+
+    def start(self):
+        if not self.is_supported():
+            return False
+
+        port = self._find_free_port()
+
+        try:
+            self._process = subprocess.Popen(
+                [
+                    self._pandoc_path,
+                    "server",
+                    "--port",
+                    str(port),
+                    "--timeout",
+                    str(self.CONVERSION_TIMEOUT),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            return False
+
+        # Unlike atexit, finalizers also run when pool worker processes exit:
+        multiprocessing.util.Finalize(None, self.close, exitpriority=0)
+
+        if self._wait_until_ready(port):
+            self._url = f"http://127.0.0.1:{port}/"
+
+            # Ensure the server is able to convert, not only accept connections:
+            try:
+                self.convert("", "html", "json")
+                return True
+            except (OSError, PandocServerError):
+                pass
+
+        self.close()
+        return False
+
+    def close(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.terminate()
+                self._process.wait()
+
+            self._process = None
+            self._url = None
+
+    def convert(self, text, from_format, to_format):
+        request = urllib.request.Request(
+            self._url,
+            data=json.dumps(
+                {"text": text, "from": from_format, "to": to_format}
+            ).encode("utf8"),
+            headers={"Accept": "application/json", "Content-Type": "application/json"},
+        )
+
+        try:
+            with self._url_opener.open(
+                request, timeout=self.CONVERSION_TIMEOUT
+            ) as response:
+                result = json.loads(response.read().decode("utf8"))
+        except urllib.error.HTTPError as error:
+            raise PandocServerError(error.read().decode("utf8", "replace")) from error
+
+        if isinstance(result, dict) and "output" in result:
+            return result["output"]
+
+        # Failed conversions are reported as an error object or a plain message:
+        error_message = result.get("error") if isinstance(result, dict) else result
+        raise PandocServerError(f"pandoc server conversion failed: {error_message}")
+
+
+def disable_shared_pandoc_server():
+    # Used as a pool initializer so workers do not retry a server known to be unavailable:
+    global _shared_pandoc_server
+
+    _shared_pandoc_server = False
+
+
+def get_shared_pandoc_server():
+    global _shared_pandoc_server
+
+    if _shared_pandoc_server is None:
+        _shared_pandoc_server = PandocServer()
+
+        if not _shared_pandoc_server.start():
+            logger.warning("pandoc server unavailable, falling back to pandoc CLI")
+            _shared_pandoc_server = False
+
+    return _shared_pandoc_server or None